@@ -25,7 +25,10 @@ import sys
 import librosa
 import soundfile
 import warnings
+import signal
 from gtts import gTTS
+from chat_persistence import ChatPersister
+from llm_client import ResilientLLM, model_chain
 
 # --- Suppress Specific Warnings ---
 warnings.filterwarnings("ignore", category=FutureWarning)
@@ -62,6 +65,16 @@ firebase_admin.initialize_app(cred, {'databaseURL': os.getenv('FIREBASE_DATABASE
 
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
+# Chat writes go through the write-behind persister; flushed on shutdown via atexit
+# (gunicorn workers exit normally on SIGTERM) or handle_sigterm when run directly.
+# Its queue is per process, so gunicorn.conf.py pins a single (threaded) worker.
+persister = ChatPersister().start()
+
+# Ordered fallback chains, e.g. LUNA_TEXT_MODELS="gemini-pro-latest,gemini-flash-latest"
+text_llm = ResilientLLM(model_chain('LUNA_TEXT_MODELS', 'gemini-pro-latest'))
+vision_llm = ResilientLLM(model_chain('LUNA_VISION_MODELS', 'models/gemini-pro-vision'))
+TITLE_FIRST_CHUNK_TIMEOUT = float(os.getenv('TITLE_FIRST_CHUNK_TIMEOUT', '5'))
+
 # --- LUNA's Base System Instruction ---
 LUNA_BASE_PERSONALITY = "You are LUNA, which stands for Logical Understanding and Neural Assistance. You are a helpful and friendly AI assistant. When asked your name, you must say you are LUNA."
 
@@ -89,6 +102,23 @@ def extract_text_from_docx(file_stream):
         text += para.text + "\n"
     return text
 
+FIREBASE_FORBIDDEN_KEY_CHARS = '.$#[]/'
+
+def is_valid_chat_id(chat_id):
+    """Chat ids become Firebase keys, which can't be empty or contain . $ # [ ] or /."""
+    return isinstance(chat_id, str) and bool(chat_id) and not any(c in chat_id for c in FIREBASE_FORBIDDEN_KEY_CHARS)
+
+def stale_history_response(user_id):
+    """
+    Flushes the user's queued writes. If some are still stuck after a transient failure,
+    returns an SSE error response, because building a turn on stale history would
+    overwrite the unsaved one.
+    """
+    if persister.flush(user_id) or not persister.has_pending(user_id):
+        return None
+    error = "Your previous messages are still being saved. Please try again in a moment."
+    return Response(f"data: {json.dumps({'error': error})}\n\n", mimetype='text/event-stream', status=503)
+
 def format_history_for_api(history):
     clean_history = []
     for msg in history:
@@ -103,9 +133,9 @@ def get_chat_title(history):
     context = "\n".join([f"{msg['role']}: {msg['parts'][0]}" for msg in history[:2] if msg.get('parts')])
     prompt = f"Analyze this conversation start:\n---\n{context}\n---\nGenerate a concise, formal, Title Case title for this chat, 5 words or less. Respond only with the title."
     try:
-        text_model = genai.GenerativeModel('gemini-pro-latest', system_instruction=LUNA_BASE_PERSONALITY)
-        response = text_model.generate_content(prompt)
-        title = response.text.strip().strip('"')
+        response_text = text_llm.generate(prompt, system_instruction=LUNA_BASE_PERSONALITY,
+                                          first_chunk_timeout=TITLE_FIRST_CHUNK_TIMEOUT)
+        title = response_text.strip().strip('"')
         return title if title else "New Chat"
     except Exception:
         return (history[0]['parts'][0][:30] + '...') if history and history[0].get('parts') else "Chat"
@@ -431,6 +461,8 @@ def translate_voice_endpoint():
 @login_required
 def chat():
     user_id = session['user_id']
+    stale_response = stale_history_response(user_id)
+    if stale_response: return stale_response
     ref = db.reference(f'users/{user_id}') # Get user's root reference
     chats_ref = ref.child('chats')
 
@@ -465,6 +497,7 @@ def chat():
     user_message_text = request.form.get('message', '')
     chat_id = request.form.get('chat_id', None)
     if chat_id == 'null': chat_id = None
+    if chat_id is not None and not is_valid_chat_id(chat_id): return jsonify({"error": "Invalid chat_id"}), 400
     
     file = request.files.get('file')
     
@@ -504,21 +537,20 @@ def chat():
             user_message['image'] = f"data:{file_info['type']};base64," + base64.b64encode(file_content).decode('utf-8')
 
     full_history = history + [user_message]
-    chat_ref = chats_ref.child(chat_id)
 
     def generate_stream():
         try:
-            model = None
+            llm = None
             api_content = None
             
             api_history = format_history_for_api(history)
             
             if is_image:
-                model = genai.GenerativeModel('models/gemini-pro-vision', system_instruction=dynamic_personality)
+                llm = vision_llm
                 img = Image.open(io.BytesIO(file_content))
                 api_content = api_history + [{'role': 'user', 'parts': [user_message_text, img]}]
             else:
-                model = genai.GenerativeModel('gemini-pro-latest', system_instruction=dynamic_personality)
+                llm = text_llm
                 prompt_text = user_message_text
                 if extracted_text:
                     prompt_text = f"Based on the content of '{file_info.get('filename')}', the user asks: {user_message_text}\n\nDocument Content:\n{extracted_text}"
@@ -528,26 +560,31 @@ def chat():
             initial_data = {"chat_id": chat_id, "user_message_id": user_message['id']}
             yield f"data: {json.dumps(initial_data)}\n\n"
 
-            response_stream = model.generate_content(
-                api_content, stream=True,
+            response_stream = llm.generate_stream(
+                api_content, system_instruction=dynamic_personality,
                 safety_settings={ HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE }
             )
             
             complete_luna_response = ""
-            for chunk in response_stream:
-                if chunk.text:
-                    complete_luna_response += chunk.text
-                    yield f"data: {json.dumps({'chunk': chunk.text})}\n\n"
+            for chunk_text in response_stream:
+                complete_luna_response += chunk_text
+                yield f"data: {json.dumps({'chunk': chunk_text})}\n\n"
             
             luna_message = {"id": current_timestamp + 1, "role": "model", "parts": [complete_luna_response]}
             final_history_to_save = full_history + [luna_message]
-            chat_ref.child('messages').set(final_history_to_save)
-            chat_ref.child('last_updated').set(current_timestamp)
+            turn_updates = {
+                f'{chat_id}/messages': final_history_to_save,
+                f'{chat_id}/last_updated': current_timestamp,
+            }
 
             if is_new_chat:
                 title = (user_message_text[:40] + '...') if user_message_text else f"File: {file_info.get('filename')}"
-                chat_ref.child('title').set(title)
-                chat_ref.child('pinned').set(False)
+                turn_updates[f'{chat_id}/title'] = title
+                turn_updates[f'{chat_id}/pinned'] = False
+
+            persister.update(user_id, turn_updates)
+
+            if is_new_chat:
                 yield f"data: {json.dumps({'is_new_chat': True})}\n\n"
 
         except Exception as e:
@@ -560,9 +597,12 @@ def chat():
 @login_required
 def edit():
     user_id = session['user_id']
+    stale_response = stale_history_response(user_id)
+    if stale_response: return stale_response
     ref = db.reference(f'users/{user_id}/chats') 
     data = request.json
     chat_id, message_id, new_text = data.get('chat_id'), data.get('message_id'), data.get('new_text')
+    if not is_valid_chat_id(chat_id): return jsonify({"error": "Invalid chat_id"}), 400
     current_timestamp = int(time.time() * 1000)
     try:
         messages = ref.child(chat_id).child('messages').get()
@@ -571,22 +611,21 @@ def edit():
         
         messages[message_index]['parts'] = [new_text]
         truncated_history = messages[:message_index + 1]
-        
-        text_model = genai.GenerativeModel('gemini-pro-latest', system_instruction=LUNA_BASE_PERSONALITY)
 
         def generate_edit_stream():
             try:
                 api_history = format_history_for_api(truncated_history)
-                response_stream = text_model.generate_content(api_history, stream=True)
+                response_stream = text_llm.generate_stream(api_history, system_instruction=LUNA_BASE_PERSONALITY)
                 complete_luna_response = ""
-                for chunk in response_stream:
-                    if chunk.text:
-                        complete_luna_response += chunk.text
-                        yield f"data: {json.dumps({'chunk': chunk.text})}\n\n"
+                for chunk_text in response_stream:
+                    complete_luna_response += chunk_text
+                    yield f"data: {json.dumps({'chunk': chunk_text})}\n\n"
                 luna_message = {"id": current_timestamp, "role": "model", "parts": [complete_luna_response]}
                 final_history = truncated_history + [luna_message]
-                ref.child(chat_id).child('messages').set(final_history)
-                ref.child(chat_id).child('last_updated').set(current_timestamp)
+                persister.update(user_id, {
+                    f'{chat_id}/messages': final_history,
+                    f'{chat_id}/last_updated': current_timestamp,
+                })
             except Exception as e:
                 yield f"data: {json.dumps({'error': str(e)})}\n\n"
         return Response(generate_edit_stream(), mimetype='text/event-stream')
@@ -598,14 +637,16 @@ def edit():
 @login_required
 def generate_title():
     user_id = session['user_id']
+    persister.flush(user_id)
     ref = db.reference(f'users/{user_id}/chats') 
     data = request.json; chat_id = data.get('chat_id')
     if not chat_id: return jsonify({"error": "Missing chat_id"}), 400
+    if not is_valid_chat_id(chat_id): return jsonify({"error": "Invalid chat_id"}), 400
     try:
         messages = ref.child(chat_id).child('messages').get()
         if not messages or len(messages) < 1: return jsonify({"error": "Not enough messages"}), 400
         smart_title = get_chat_title(messages)
-        ref.child(chat_id).child('title').set(smart_title)
+        persister.update(user_id, {f'{chat_id}/title': smart_title})
         return jsonify({"success": True, "title": smart_title})
     except Exception as e: return jsonify({"error": "Failed to generate title"}), 500
 
@@ -613,6 +654,7 @@ def generate_title():
 @login_required
 def history():
     user_id = session['user_id']
+    persister.flush(user_id)
     ref = db.reference(f'users/{user_id}/chats') 
     all_chats_raw = ref.get(); chat_list = []
     if all_chats_raw:
@@ -625,6 +667,7 @@ def history():
 @login_required
 def get_chat(chat_id):
     user_id = session['user_id']
+    persister.flush(user_id)
     ref = db.reference(f'users/{user_id}/chats')
     chat_data = ref.child(chat_id).child('messages').get()
     return jsonify(chat_data or [])
@@ -633,33 +676,229 @@ def get_chat(chat_id):
 @login_required
 def rename_chat():
     user_id = session['user_id']
-    ref = db.reference(f'users/{user_id}/chats') 
     data = request.json; chat_id, new_title = data.get('chat_id'), data.get('new_title')
     if not all([chat_id, new_title]): return jsonify({"error": "Missing data"}), 400
-    ref.child(chat_id).child('title').set(new_title)
-    ref.child(chat_id).child('last_updated').set(int(time.time() * 1000))
+    if not is_valid_chat_id(chat_id): return jsonify({"error": "Invalid chat_id"}), 400
+    persister.update(user_id, {
+        f'{chat_id}/title': new_title,
+        f'{chat_id}/last_updated': int(time.time() * 1000),
+    })
     return jsonify({"success": True})
 
 @app.route('/delete_chat', methods=['POST'])
 @login_required
 def delete_chat():
     user_id = session['user_id']
-    ref = db.reference(f'users/{user_id}/chats') 
     data = request.json; chat_id = data.get('chat_id')
     if not chat_id: return jsonify({"error": "Missing chat_id"}), 400
-    ref.child(chat_id).delete()
+    if not is_valid_chat_id(chat_id): return jsonify({"error": "Invalid chat_id"}), 400
+    # Queued behind any pending turn writes so the chat can't be recreated after deletion.
+    persister.update(user_id, {chat_id: None})
     return jsonify({"success": True})
 
 @app.route('/pin_chat', methods=['POST'])
 @login_required
 def pin_chat():
     user_id = session['user_id']
-    ref = db.reference(f'users/{user_id}/chats') 
     data = request.json; chat_id, pin_status = data.get('chat_id'), data.get('pin_status')
     if not chat_id or pin_status is None: return jsonify({"error": "Missing data"}), 400
-    ref.child(chat_id).child('pinned').set(pin_status)
+    if not is_valid_chat_id(chat_id): return jsonify({"error": "Invalid chat_id"}), 400
+    persister.update(user_id, {f'{chat_id}/pinned': pin_status})
     return jsonify({"success": True})
-    
+
+# --- Bulk Chat Routes ---
+EXPORT_PAGE_SIZE = 20   # chats fetched from Firebase per export query
+IMPORT_BATCH_SIZE = 20  # chats written per multi-path update on import
+
+def existing_chat_ids(user_id):
+    """Returns the user's chat ids without downloading any chat contents."""
+    persister.flush(user_id)
+    return set((db.reference(f'users/{user_id}/chats').get(shallow=True) or {}).keys())
+
+def bulk_chat_request(user_id):
+    """Parses a {"chat_ids": [...]} body, splitting ids into existing and missing."""
+    chat_ids = (request.json or {}).get('chat_ids')
+    if not isinstance(chat_ids, list) or not chat_ids:
+        return None, None
+    known = existing_chat_ids(user_id)
+    chat_ids = list(dict.fromkeys(str(chat_id) for chat_id in chat_ids))
+    return [c for c in chat_ids if c in known], [c for c in chat_ids if c not in known]
+
+@app.route('/bulk_delete_chats', methods=['POST'])
+@login_required
+def bulk_delete_chats():
+    user_id = session['user_id']
+    chat_ids, missing = bulk_chat_request(user_id)
+    if chat_ids is None: return jsonify({"error": "Missing chat_ids"}), 400
+    persister.update(user_id, {chat_id: None for chat_id in chat_ids})
+    return jsonify({"success": True, "updated": chat_ids, "missing": missing})
+
+@app.route('/bulk_pin_chats', methods=['POST'])
+@login_required
+def bulk_pin_chats():
+    user_id = session['user_id']
+    pin_status = (request.json or {}).get('pin_status')
+    if not isinstance(pin_status, bool): return jsonify({"error": "pin_status must be true or false"}), 400
+    chat_ids, missing = bulk_chat_request(user_id)
+    if chat_ids is None: return jsonify({"error": "Missing chat_ids"}), 400
+    persister.update(user_id, {f'{chat_id}/pinned': pin_status for chat_id in chat_ids})
+    return jsonify({"success": True, "updated": chat_ids, "missing": missing})
+
+@app.route('/bulk_rename_chats', methods=['POST'])
+@login_required
+def bulk_rename_chats():
+    user_id = session['user_id']
+    titles = (request.json or {}).get('titles')
+    if not isinstance(titles, dict) or not titles: return jsonify({"error": "Missing titles"}), 400
+    known = existing_chat_ids(user_id)
+    current_timestamp = int(time.time() * 1000)
+    updates, updated, missing, invalid = {}, [], [], []
+    for chat_id, new_title in titles.items():
+        if chat_id not in known:
+            missing.append(chat_id)
+            continue
+        if not isinstance(new_title, str) or not new_title.strip():
+            invalid.append(chat_id)
+            continue
+        updates[f'{chat_id}/title'] = new_title
+        updates[f'{chat_id}/last_updated'] = current_timestamp
+        updated.append(chat_id)
+    persister.update(user_id, updates)
+    return jsonify({"success": True, "updated": updated, "missing": missing, "invalid": invalid})
+
+@app.route('/export_chats', methods=['GET'])
+@login_required
+def export_chats():
+    """Streams every chat as one NDJSON line, fetching a page of chats at a time."""
+    user_id = session['user_id']
+    persister.flush(user_id)
+    ref = db.reference(f'users/{user_id}/chats')
+
+    def generate_export():
+        last_key = None
+        try:
+            while True:
+                query = ref.order_by_key()
+                if last_key is not None:
+                    query = query.start_at(last_key)
+                # start_at is inclusive, so ask for one extra row to skip the previous page's last chat.
+                # firebase_admin re-sorts keys as plain strings, which matches the server's order
+                # only because chat ids are never integer-like (see /import_chats).
+                page = query.limit_to_first(EXPORT_PAGE_SIZE + (last_key is not None)).get() or {}
+                rows = [(k, v) for k, v in page.items() if k != last_key]
+                for chat_id, data in rows:
+                    chat = {
+                        "id": chat_id,
+                        "title": data.get('title', 'Untitled Chat'),
+                        "last_updated": data.get('last_updated', 0),
+                        "pinned": data.get('pinned', False),
+                        "messages": data.get('messages') or [],
+                    }
+                    yield json.dumps(chat) + "\n"
+                if len(rows) < EXPORT_PAGE_SIZE:
+                    return
+                last_key = rows[-1][0]
+        except Exception as e:
+            # Headers are already sent, so mark the file as incomplete in-band.
+            print(f"Error in export stream: {repr(e)}", flush=True)
+            yield json.dumps({"error": f"Export incomplete: {e}"}) + "\n"
+
+    response = Response(generate_export(), mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = 'attachment; filename=luna_chats.ndjson'
+    return response
+
+def has_forbidden_keys(value):
+    """True if any dict key in a nested value is empty or can't be a Firebase key."""
+    if isinstance(value, dict):
+        return any(not key or any(c in key for c in FIREBASE_FORBIDDEN_KEY_CHARS) or has_forbidden_keys(v)
+                   for key, v in value.items())
+    if isinstance(value, list):
+        return any(has_forbidden_keys(v) for v in value)
+    return False
+
+def parse_imported_chat(chat):
+    """Validates one exported chat and returns the record to store. Raises ValueError if invalid."""
+    if not isinstance(chat, dict):
+        raise ValueError("each line must be a JSON object")
+    messages = chat.get('messages')
+    if not isinstance(messages, list):
+        raise ValueError("messages must be a list")
+    for i, msg in enumerate(messages):
+        if not isinstance(msg, dict):
+            raise ValueError(f"message {i} must be an object")
+        if isinstance(msg.get('id'), bool) or not isinstance(msg.get('id'), (int, str)):
+            raise ValueError(f"message {i} needs an id")
+        if msg.get('role') not in ('user', 'model'):
+            raise ValueError(f"message {i} role must be 'user' or 'model'")
+        if not isinstance(msg.get('parts'), list) or not all(isinstance(part, str) for part in msg['parts']):
+            raise ValueError(f"message {i} parts must be a list of strings")
+    if has_forbidden_keys(messages):
+        raise ValueError(f"keys can't be empty or contain any of {FIREBASE_FORBIDDEN_KEY_CHARS}")
+    return {
+        "title": str(chat.get('title') or 'Imported Chat'),
+        "last_updated": int(chat.get('last_updated') or time.time() * 1000),
+        "pinned": chat.get('pinned') is True,
+        "messages": messages,
+    }
+
+@app.route('/import_chats', methods=['POST'])
+@login_required
+def import_chats():
+    """Imports chats from an NDJSON upload (as produced by /export_chats), one line at a time."""
+    user_id = session['user_id']
+    file = request.files.get('file')
+    stream = file.stream if file else request.stream
+    ref = db.reference(f'users/{user_id}/chats')
+    known = existing_chat_ids(user_id)
+
+    imported, errors, save_failed = 0, [], False
+    updates, update_lines = {}, []
+
+    def write_batch():
+        # Written directly rather than through the persister, so every batch's
+        # outcome is known before the response reports it.
+        nonlocal imported, save_failed
+        if not updates: return
+        try:
+            ref.update(updates)
+            imported += len(updates)
+        except Exception as e:
+            save_failed = True
+            print(f"Error importing chats for user {user_id}: {repr(e)}", flush=True)
+            errors.extend({"line": line_number, "error": f"Failed to save: {e}"} for line_number in update_lines)
+        updates.clear(); update_lines.clear()
+
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line: continue
+        try:
+            chat = json.loads(line)
+            record = parse_imported_chat(chat)
+        except (ValueError, TypeError, OverflowError) as e:
+            errors.append({"line": line_number, "error": str(e)})
+            continue
+
+        # Never overwrite an existing chat; re-importing an export creates copies instead.
+        # Integer-like keys are replaced too: Firebase orders them before all other keys,
+        # which would break the key-ordered paging in /export_chats.
+        chat_id = chat.get('id')
+        if not is_valid_chat_id(chat_id) or chat_id.lstrip('-').isdigit() or chat_id in known:
+            chat_id = str(uuid.uuid4())
+        known.add(chat_id)
+        updates[chat_id] = record
+        update_lines.append(line_number)
+        if len(updates) >= IMPORT_BATCH_SIZE:
+            write_batch()
+
+    write_batch()
+    return jsonify({"success": not save_failed, "imported": imported, "errors": errors}), (500 if save_failed else 200)
+
+@app.route('/llm_stats', methods=['GET'])
+@login_required
+def llm_stats():
+    """Per-model latency, error and circuit breaker stats for the Gemini fallback chains."""
+    return jsonify({"text": text_llm.stats(), "vision": vision_llm.stats()})
+
 @app.route('/update_model', methods=['POST'])
 @login_required
 def update_model():
@@ -676,5 +915,13 @@ def update_model():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def handle_sigterm(signum, frame):
+    """SIGTERM skips atexit by default, so write any queued chat turns before exiting."""
+    persister.shutdown()
+    sys.exit(0)
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    # No reloader: it serves from a child process and SIGKILLs it when the parent gets
+    # SIGTERM, losing the child's queued chat writes.
+    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,226 @@
+import atexit
+import os
+import sys
+import threading
+import time
+
+from firebase_admin import db
+
+
+# --- Write-Behind Chat Persistence ---
+# Chat writes are queued per user and sent to Firebase from a background thread
+# as one multi-path update, so streaming responses can close without waiting on
+# the database. Reads that need fresh data call flush(user_id) first.
+#
+# The queue lives in process memory, so flush(user_id) only covers writes made by the
+# same process. The app must run as a single process (see gunicorn.conf.py); use
+# threads, not workers, for concurrency.
+
+PERSIST_BATCH_WINDOW = 0.05      # seconds to wait for more writes before flushing
+PERSIST_RETRY_DELAY = 0.5        # backoff after a transient failure, doubled per consecutive failure
+PERSIST_MAX_RETRY_DELAY = 30     # backoff cap, so writes resume soon after an outage ends
+PERSIST_SHUTDOWN_ATTEMPTS = 3    # last-chance attempts for queued writes on shutdown
+
+
+def is_permanent_error(error):
+    """
+    True for failures that retrying can't fix: invalid paths or values, and HTTP 4xx
+    responses other than timeouts and rate limiting.
+    """
+    if isinstance(error, (ValueError, TypeError)):
+        return True
+    status = getattr(getattr(error, 'http_response', None), 'status_code', None)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+
+def _overlaps(path_a, path_b):
+    """True if one path is the same as, or an ancestor of, the other."""
+    a, b = path_a + '/', path_b + '/'
+    return a.startswith(b) or b.startswith(a)
+
+
+def _split_by_chat(batch):
+    """Splits a batch into one batch per chat id (the first path segment), keeping order."""
+    per_chat = {}
+    for path, value in batch.items():
+        per_chat.setdefault(path.split('/', 1)[0], {})[path] = value
+    return list(per_chat.values())
+
+
+class ChatPersister:
+    def __init__(self, reference_factory=None, batch_window=PERSIST_BATCH_WINDOW,
+                 retry_delay=PERSIST_RETRY_DELAY, max_retry_delay=PERSIST_MAX_RETRY_DELAY):
+        self._reference = reference_factory or db.reference
+        self.batch_window = batch_window
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._pending = {}      # user_id -> list of {path: value} batches, oldest first
+        self._user_locks = {}   # user_id -> lock held while that user's batches are written
+        self._retry_at = {}     # user_id -> monotonic time before which the user is backing off
+        self._failures = {}     # user_id -> consecutive transient failures
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._start_thread()
+            atexit.register(self.shutdown)
+            # Threads don't survive fork (e.g. gunicorn --preload), so restart in the child.
+            os.register_at_fork(after_in_child=self._after_fork)
+        return self
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target=self._run, name="chat-persister", daemon=True)
+        self._thread.start()
+
+    def _after_fork(self):
+        # Locks may have been held by parent threads at fork time, and the parent still
+        # owns (and will write) anything it had queued, so the child starts clean.
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._pending, self._user_locks, self._retry_at, self._failures = {}, {}, {}, {}
+        if not self._stopped:
+            self._start_thread()
+
+    def update(self, user_id, updates):
+        """Queues {path: value} writes relative to users/<user_id>/chats. A value of None deletes."""
+        if not updates:
+            return
+        with self._lock:
+            batches = self._pending.setdefault(user_id, [])
+            for path, value in updates.items():
+                path = path.strip('/')
+                batch = batches[-1] if batches else None
+                if batch is not None and path not in batch and any(_overlaps(path, p) for p in batch):
+                    # Firebase rejects ancestor/descendant paths in a single update,
+                    # so keep ordering by starting a new batch.
+                    batch = None
+                if batch is None:
+                    batch = {}
+                    batches.append(batch)
+                batch[path] = value
+            self._user_locks.setdefault(user_id, threading.Lock())
+        if self._thread is None or self._stopped:
+            self.flush(user_id)
+        else:
+            self._wakeup.set()
+
+    def flush(self, user_id=None):
+        """
+        Synchronously writes pending batches for one user, or for everyone if user_id is None.
+        Never sleeps: a user backing off after a transient failure is skipped, and each batch
+        gets a single attempt. Returns False if any batch was rejected and dropped, or is
+        still queued, so callers know the database may not reflect every write.
+        """
+        now = time.monotonic()
+        with self._lock:
+            user_ids = [user_id] if user_id is not None else list(self._pending)
+            backing_off = {uid for uid in user_ids if self._retry_at.get(uid, 0) > now}
+        ok = True
+        for uid in user_ids:
+            if uid in backing_off:
+                ok = not self.has_pending(uid) and ok
+            else:
+                ok = self._flush_user(uid) and ok
+        return ok
+
+    def has_pending(self, user_id):
+        """True while writes for the user are still queued, e.g. after a transient failure."""
+        with self._lock:
+            return bool(self._pending.get(user_id))
+
+    def shutdown(self):
+        """Stops the worker and writes everything still queued so no turn is lost."""
+        self._stopped = True
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=10)
+        ok = True
+        for attempt in range(PERSIST_SHUTDOWN_ATTEMPTS):
+            if attempt:
+                time.sleep(self.retry_delay)
+            with self._lock:
+                self._retry_at.clear()  # backoff no longer matters; this is the last chance
+            ok = self.flush()
+            with self._lock:
+                lost = {uid: len(batches) for uid, batches in self._pending.items() if batches}
+            if not lost:
+                return ok
+        print(f"Chat persister shut down with unsaved writes (user: batches): {lost}", file=sys.stderr, flush=True)
+        return False
+
+    def _run(self):
+        while not self._stopped:
+            # Sleep until woken by a new write, or until the earliest backing-off user is due.
+            with self._lock:
+                due = [self._retry_at[uid] for uid in self._pending if uid in self._retry_at]
+            self._wakeup.wait(timeout=max(0.0, min(due) - time.monotonic()) if due else None)
+            if self._stopped:
+                break
+            # Let a burst of writes (e.g. a turn plus its title) land in the same update.
+            if self._stop.wait(self.batch_window):
+                break
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error in chat persister: {repr(e)}", file=sys.stderr, flush=True)
+
+    def _flush_user(self, user_id):
+        with self._lock:
+            user_lock = self._user_locks.get(user_id)
+        if user_lock is None:
+            return True
+        ok = True
+        # Holding the user's lock while writing means a concurrent flush(user_id)
+        # waits for in-flight batches instead of reading stale data.
+        with user_lock:
+            while True:
+                with self._lock:
+                    batches = self._pending.get(user_id)
+                    if not batches:
+                        self._pending.pop(user_id, None)
+                        return ok
+                    batch = batches.pop(0)
+                result = self._write(user_id, batch)
+                per_chat = _split_by_chat(batch)
+                if result == "dropped" and len(per_chat) > 1:
+                    # One bad chat shouldn't sink the others coalesced with it; retry each separately.
+                    with self._lock:
+                        self._pending.setdefault(user_id, [])[:0] = per_chat
+                elif result == "dropped":
+                    # Rejected for good; keep going so later writes aren't stuck behind it.
+                    ok = False
+                elif result == "failed":
+                    with self._lock:
+                        self._pending.setdefault(user_id, []).insert(0, batch)
+                        # Back off this user only; the worker keeps serving everyone else.
+                        failures = self._failures[user_id] = self._failures.get(user_id, 0) + 1
+                        delay = min(self.max_retry_delay, self.retry_delay * 2 ** (failures - 1))
+                        self._retry_at[user_id] = time.monotonic() + delay
+                    print(f"Retrying chat writes for user {user_id} in {delay:.1f}s "
+                          f"(failure {failures})", file=sys.stderr, flush=True)
+                    return False
+                else:
+                    with self._lock:
+                        self._failures.pop(user_id, None)
+                        self._retry_at.pop(user_id, None)
+
+    def _write(self, user_id, batch):
+        """Makes one attempt. Returns "written", "dropped" for permanent failures, or "failed"."""
+        try:
+            self._reference(f'users/{user_id}/chats').update(batch)
+            return "written"
+        except Exception as e:
+            if is_permanent_error(e):
+                print(f"Chat write for user {user_id} rejected by Firebase: {repr(e)} "
+                      f"(paths: {', '.join(batch)})", file=sys.stderr, flush=True)
+                return "dropped"
+            print(f"Chat write failed for user {user_id}: {repr(e)}", file=sys.stderr, flush=True)
+            return "failed"
@@ -0,0 +1,19 @@
+# --- Gunicorn Settings ---
+# Loaded automatically when gunicorn is started from this directory.
+# Chat writes are queued in process memory (see chat_persistence.py), and a request
+# only sees writes queued by its own process. A second worker could serve /history
+# or /generate_title before the first worker has saved the turn, so LUNA runs as one
+# worker and gets its concurrency from threads.
+import os
+
+workers = 1
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+
+def on_starting(server):
+    if server.cfg.workers != 1:
+        raise RuntimeError(
+            f"LUNA must run with a single gunicorn worker (got {server.cfg.workers}); "
+            "raise GUNICORN_THREADS for more concurrency instead."
+        )
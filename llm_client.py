@@ -0,0 +1,326 @@
+import os
+import queue
+import sys
+import threading
+import time
+
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+
+# --- Resilient Gemini Client ---
+# Wraps genai.GenerativeModel with a time-to-first-chunk deadline, a hedged second
+# request, an ordered fallback chain of models and a circuit breaker per model.
+# Any callable with the GenerativeModel signature can be passed as model_factory,
+# so a local fake model can stand in for Gemini.
+
+LLM_HEDGE_DELAY = float(os.getenv('LLM_HEDGE_DELAY', '3'))                   # seconds before a hedged request is sent
+LLM_FIRST_CHUNK_TIMEOUT = float(os.getenv('LLM_FIRST_CHUNK_TIMEOUT', '15'))  # seconds per model to get a first chunk
+LLM_CHUNK_TIMEOUT = float(os.getenv('LLM_CHUNK_TIMEOUT', '60'))              # max gap between later chunks
+LLM_BREAKER_THRESHOLD = int(os.getenv('LLM_BREAKER_THRESHOLD', '3'))         # consecutive failures before opening
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', '30'))        # seconds a breaker stays open
+
+
+def model_chain(env_name, default):
+    """Reads an ordered, comma-separated model list from the environment."""
+    return [name.strip() for name in os.getenv(env_name, default).split(',') if name.strip()]
+
+
+def is_transient_error(error):
+    """
+    True for errors that say something about the model's health (timeouts, 429 and 5xx),
+    as opposed to errors caused by the request itself, such as a blocked prompt or a 400.
+    Only transient errors are hedged, retried on a fallback model or counted by breakers.
+    """
+    if isinstance(error, (TimeoutError, ConnectionError, google_exceptions.RetryError)):
+        return True
+    if isinstance(error, google_exceptions.GoogleAPICallError):
+        return error.code == 429 or (error.code is not None and error.code >= 500)
+    return False
+
+
+class LLMUnavailableError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=LLM_BREAKER_THRESHOLD, cooldown=LLM_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """
+        Returns "closed" if the request may go through, "trial" if it took the single
+        half-open trial slot (and must report back with trial=True), or None if blocked.
+        """
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return "closed"
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return "trial"
+            return None
+
+    def release(self):
+        """Frees the half-open trial slot taken by allow() when its outcome won't be reported."""
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self, trial=False):
+        with self._lock:
+            self.failures += 1
+            # Only the trial request may free the slot; a late failure from an older
+            # request must not let a second trial through alongside it.
+            if trial:
+                self._trial_running = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class ModelStats:
+    def __init__(self):
+        self.requests = 0
+        self.successes = 0
+        self.errors = 0
+        self.client_errors = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.first_chunk_total = 0.0
+        self.total_latency = 0.0
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "successes": self.successes,
+            "errors": self.errors,
+            "client_errors": self.client_errors,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "avg_first_chunk_ms": round(1000 * self.first_chunk_total / self.successes) if self.successes else None,
+            "avg_latency_ms": round(1000 * self.total_latency / self.successes) if self.successes else None,
+        }
+
+
+class _Attempt:
+    """One generate_content(stream=True) call, drained into a shared queue by a daemon thread."""
+
+    def __init__(self, attempt_id, model, contents, kwargs, results):
+        self.id = attempt_id
+        self.cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(model, contents, kwargs, results), daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self, model, contents, kwargs, results):
+        try:
+            for chunk in model.generate_content(contents, stream=True, **kwargs):
+                if self.cancelled.is_set():
+                    return
+                if chunk.text:
+                    results.put((self.id, "chunk", chunk.text))
+            results.put((self.id, "done", None))
+        except Exception as e:
+            results.put((self.id, "error", e))
+
+
+class ResilientLLM:
+    def __init__(self, model_names, model_factory=None, hedge_delay=LLM_HEDGE_DELAY,
+                 first_chunk_timeout=LLM_FIRST_CHUNK_TIMEOUT, chunk_timeout=LLM_CHUNK_TIMEOUT,
+                 breaker_threshold=LLM_BREAKER_THRESHOLD, breaker_cooldown=LLM_BREAKER_COOLDOWN):
+        if not model_names:
+            raise ValueError("At least one model name is required")
+        self.model_names = list(model_names)
+        self.model_factory = model_factory or genai.GenerativeModel
+        self.hedge_delay = hedge_delay
+        self.first_chunk_timeout = first_chunk_timeout
+        self.chunk_timeout = chunk_timeout
+        self.breakers = {name: CircuitBreaker(breaker_threshold, breaker_cooldown) for name in self.model_names}
+        self._stats = {name: ModelStats() for name in self.model_names}
+        self._stats_lock = threading.Lock()
+
+    def generate_stream(self, contents, system_instruction=None, first_chunk_timeout=None, **kwargs):
+        """Yields response text chunks from the first model in the chain that answers in time."""
+        last_error = None
+        tried = False
+        for name in self.model_names:
+            admission = self.breakers[name].allow()
+            if admission is None:
+                continue
+            tried = True
+            try:
+                attempt_stream = self._stream_from(name, contents, system_instruction, first_chunk_timeout,
+                                                   admission == "trial", kwargs)
+                first = next(attempt_stream, None)
+            except Exception as e:
+                if not (is_transient_error(e) or isinstance(e, LLMUnavailableError)):
+                    # The request itself is bad; another model would reject it too.
+                    raise
+                last_error = e
+                print(f"LLM model '{name}' failed, trying next fallback: {repr(e)}", file=sys.stderr, flush=True)
+                continue
+            # Once text reaches the caller we are committed to this model; later errors propagate.
+            if first is not None:
+                yield first
+            yield from attempt_stream
+            return
+        if not tried:
+            # Fail fast rather than sending traffic to models known to be failing.
+            raise LLMUnavailableError(f"Circuit breakers are open for every model ({', '.join(self.model_names)})")
+        raise LLMUnavailableError(f"No model available ({', '.join(self.model_names)}): {last_error}")
+
+    def generate(self, contents, system_instruction=None, first_chunk_timeout=None, **kwargs):
+        """Non-streaming convenience wrapper that returns the full response text."""
+        return "".join(self.generate_stream(contents, system_instruction, first_chunk_timeout, **kwargs))
+
+    def stats(self):
+        with self._stats_lock:
+            return {name: dict(self._stats[name].as_dict(), breaker=self.breakers[name].state)
+                    for name in self.model_names}
+
+    def _record(self, name, **changes):
+        with self._stats_lock:
+            stats = self._stats[name]
+            for field, value in changes.items():
+                setattr(stats, field, getattr(stats, field) + value)
+
+    def _stream_from(self, name, contents, system_instruction, first_chunk_timeout, trial, kwargs):
+        """
+        Generator for a single model. The first next() blocks until a first chunk arrives,
+        sending a hedged duplicate request if the primary is slower than hedge_delay.
+        Raises if neither request produces anything before the first-chunk deadline.
+        trial says whether this call holds the breaker's half-open trial slot.
+        """
+        breaker = self.breakers[name]
+        self._record(name, requests=1)
+        try:
+            model = self.model_factory(name, system_instruction=system_instruction)
+        except Exception as e:
+            breaker.record_failure(trial)
+            self._record(name, errors=1)
+            raise LLMUnavailableError(f"Could not create model '{name}': {repr(e)}") from e
+        results = queue.Queue()
+        started = time.monotonic()
+        deadline = started + (first_chunk_timeout or self.first_chunk_timeout)
+        attempts = {0: _Attempt(0, model, contents, kwargs, results).start()}
+        failed = set()
+        winner = None
+        first_chunk = None
+
+        # --- Wait for the first chunk, hedging once ---
+        while winner is None:
+            now = time.monotonic()
+            if now >= deadline:
+                for attempt in attempts.values():
+                    attempt.cancelled.set()
+                # A tighter deadline chosen by the caller (e.g. titles) says nothing about model
+                # health, so it must not trip the breaker shared with chat requests.
+                if first_chunk_timeout is None:
+                    breaker.record_failure(trial)
+                elif trial:
+                    breaker.release()
+                self._record(name, timeouts=1)
+                raise TimeoutError(f"No response from '{name}' within {deadline - started:.1f}s")
+            wait_until = deadline
+            if len(attempts) == 1 and 0 not in failed:
+                wait_until = min(deadline, started + self.hedge_delay)
+            try:
+                attempt_id, kind, payload = results.get(timeout=max(0.0, wait_until - now))
+            except queue.Empty:
+                if len(attempts) == 1 and time.monotonic() < deadline:
+                    attempts[1] = _Attempt(1, model, contents, kwargs, results).start()
+                    self._record(name, hedges=1)
+                continue
+            if kind == "error":
+                failed.add(attempt_id)
+                if not is_transient_error(payload):
+                    # Sending the same bad request again would fail the same way.
+                    for attempt in attempts.values():
+                        attempt.cancelled.set()
+                    if trial:
+                        breaker.release()
+                    self._record(name, client_errors=1)
+                    raise payload
+                # A fast failure of the primary is hedged immediately rather than after the delay.
+                if len(attempts) == 1:
+                    attempts[1] = _Attempt(1, model, contents, kwargs, results).start()
+                    self._record(name, hedges=1)
+                    continue
+                if failed == set(attempts):
+                    breaker.record_failure(trial)
+                    self._record(name, errors=1)
+                    raise payload
+                continue
+            winner = attempt_id
+            first_chunk = payload if kind == "chunk" else None
+            for attempt in attempts.values():
+                if attempt.id != winner:
+                    attempt.cancelled.set()
+
+        first_chunk_latency = time.monotonic() - started
+        if winner == 1:
+            self._record(name, hedge_wins=1)
+        if kind == "done":
+            breaker.record_success()
+            self._record(name, successes=1, first_chunk_total=first_chunk_latency, total_latency=first_chunk_latency)
+            return
+
+        # --- Relay the rest of the winning stream ---
+        finished = False
+        try:
+            yield first_chunk
+            while True:
+                try:
+                    attempt_id, kind, payload = results.get(timeout=self.chunk_timeout)
+                except queue.Empty:
+                    finished = True
+                    breaker.record_failure(trial)
+                    self._record(name, timeouts=1)
+                    raise TimeoutError(f"Stream from '{name}' stalled for {self.chunk_timeout:.0f}s")
+                if attempt_id != winner:
+                    continue
+                if kind == "chunk":
+                    yield payload
+                elif kind == "done":
+                    finished = True
+                    breaker.record_success()
+                    self._record(name, successes=1, first_chunk_total=first_chunk_latency,
+                                 total_latency=time.monotonic() - started)
+                    return
+                else:
+                    finished = True
+                    if is_transient_error(payload):
+                        breaker.record_failure(trial)
+                        self._record(name, errors=1)
+                    else:
+                        if trial:
+                            breaker.release()
+                        self._record(name, client_errors=1)
+                    raise payload
+        finally:
+            # Covers the caller abandoning the stream, e.g. the browser disconnecting.
+            attempts[winner].cancelled.set()
+            if not finished and trial:
+                breaker.release()
@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from llm_client import LLMUnavailableError, ResilientLLM
+
+
+# --- Fake Gemini ---
+# Stands in for genai.GenerativeModel via model_factory. Each model name maps to a
+# list of behaviours, one per generate_content call (the last one repeats):
+# "ok", "slow", or an exception instance to raise.
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModelFactory:
+    def __init__(self, behaviours):
+        self.behaviours = behaviours
+        self.calls = {name: 0 for name in behaviours}
+        self._lock = threading.Lock()
+        self.released = threading.Event()
+
+    def __call__(self, name, system_instruction=None):
+        return FakeModel(self, name)
+
+
+class FakeModel:
+    def __init__(self, factory, name):
+        self.factory = factory
+        self.name = name
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        with self.factory._lock:
+            index = self.factory.calls[self.name]
+            self.factory.calls[self.name] += 1
+        script = self.factory.behaviours[self.name]
+        behaviour = script[min(index, len(script) - 1)]
+        if isinstance(behaviour, Exception):
+            raise behaviour
+        if behaviour == "slow":
+            self.factory.released.wait(timeout=5)
+        yield FakeChunk(f"{self.name}:")
+        yield FakeChunk("hello")
+
+
+def make_llm(behaviours, **options):
+    factory = FakeModelFactory(behaviours)
+    options = dict(dict(hedge_delay=0.05, first_chunk_timeout=1, breaker_threshold=1, breaker_cooldown=60), **options)
+    llm = ResilientLLM(list(behaviours), model_factory=factory, **options)
+    return llm, factory
+
+
+def test_hedged_request_wins_when_primary_is_slow():
+    llm, factory = make_llm({"primary": ["slow", "ok"]})
+    try:
+        started = time.monotonic()
+        assert llm.generate("hi") == "primary:hello"
+        assert time.monotonic() - started < 1
+    finally:
+        factory.released.set()
+    stats = llm.stats()["primary"]
+    assert factory.calls["primary"] == 2
+    assert stats["hedges"] == 1 and stats["hedge_wins"] == 1
+
+
+def test_falls_back_to_next_model_on_5xx():
+    llm, factory = make_llm({"primary": [google_exceptions.ServiceUnavailable("down")], "backup": ["ok"]})
+    assert llm.generate("hi") == "backup:hello"
+    stats = llm.stats()
+    assert stats["primary"]["errors"] == 1 and stats["primary"]["breaker"] == "open"
+    assert stats["backup"]["successes"] == 1
+
+
+def test_client_error_is_not_hedged_and_does_not_trip_breaker():
+    llm, factory = make_llm({"primary": [google_exceptions.InvalidArgument("bad prompt")], "backup": ["ok"]})
+    for _ in range(3):
+        with pytest.raises(google_exceptions.InvalidArgument):
+            llm.generate("hi")
+    stats = llm.stats()["primary"]
+    assert factory.calls == {"primary": 3, "backup": 0}
+    assert stats["client_errors"] == 3 and stats["hedges"] == 0
+    assert stats["breaker"] == "closed"
+
+
+def test_open_breakers_fail_fast_without_calling_the_model():
+    llm, factory = make_llm({"primary": [google_exceptions.ServiceUnavailable("down")]})
+    with pytest.raises(LLMUnavailableError):
+        llm.generate("hi")
+    calls_before = factory.calls["primary"]
+
+    started = time.monotonic()
+    with pytest.raises(LLMUnavailableError, match="Circuit breakers are open"):
+        llm.generate("hi")
+    assert time.monotonic() - started < 0.05
+    assert factory.calls["primary"] == calls_before
+
+
+def test_caller_deadline_does_not_trip_breaker():
+    llm, factory = make_llm({"primary": ["slow"]})
+    try:
+        with pytest.raises(LLMUnavailableError):
+            llm.generate("hi", first_chunk_timeout=0.1)
+    finally:
+        factory.released.set()
+    assert llm.stats()["primary"]["breaker"] == "closed"